@@ -5,6 +5,19 @@ import time
 
 DEFAULT_GOBBBBLER_URL = 'https://gobbbbler.org'
 
+class GobbbblerError( ValueError ):
+    """ error returned by the gobbbbler service """
+    pass
+
+class GobbbblerUnavailableError( GobbbblerError ):
+    """ gobbbbler service is overloaded or cannot reach its database.  retry_after is the number of
+        seconds the service asked us to wait before trying again, or None if it did not say.
+    """
+
+    def __init__( self, message, retry_after=None ):
+        super().__init__( message )
+        self.retry_after = retry_after
+
 class Turkey:
 
     def __init__( self, username=None, password=None, url=DEFAULT_GOBBBBLER_URL ):
@@ -17,10 +30,30 @@ class Turkey:
         self.password = password
         self.url = url
 
+    def _check_response( self, r ):
+        """ raise a GobbbblerError if the response is an error; otherwise return the decoded json """
+
+        if ( r.status_code == 503 ):
+            retry_after = r.headers.get( 'Retry-After' )
+            retry_after = int( retry_after ) if ( retry_after and retry_after.isdigit() ) else None
+            raise GobbbblerUnavailableError( 'gobbbbler is unavailable: ' + r.text, retry_after )
+
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            raise GobbbblerError( str( e ) ) from e
+
+        response_json = r.json()
+
+        if ( 'error' in response_json ):
+            raise GobbbblerError( response_json[ 'error' ] )
+
+        return response_json
+
     def _get_posts_from_json_response( self, r ):
         """ return a simple list of post texts from the json response """
 
-        posts_json = r.json()
+        posts_json = self._check_response( r )
 
         if ( not 'posts' in posts_json ):
             raise ValueError( 'json response does not include post: ' + r.text )
@@ -41,8 +74,6 @@ class Turkey:
         params = { 'username': self.username, 'password': self.password  };
         r = requests.post( self.url + "/api/posts/send", params = params, json = { 'post': post } )
 
-        r.raise_for_status
-
         return self._get_posts_from_json_response( r )
 
 
@@ -55,8 +86,6 @@ class Turkey:
         params = { 'username': self.username, 'password': self.password  };
         r = requests.get( self.url + "/api/posts/list", params = params )
 
-        r.raise_for_status()
-
         return self._get_posts_from_json_response( r )
 
     def _get_first_user_post( self, user ):
@@ -67,9 +96,7 @@ class Turkey:
         params = { 'username': self.username, 'password': self.password, 'user': user }
         r = requests.get( self.url + "/api/posts/user", params = params )
 
-        r.raise_for_status()
-
-        posts_json = r.json()
+        posts_json = self._check_response( r )
 
         if ( not 'posts' in posts_json ):
             raise ValueError( 'json response does not include post: ' + r.text )
@@ -10,14 +10,17 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import contextlib
+import functools
 import os
 import sqlalchemy
+import threading
 import time
 
 from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Date
 from sqlalchemy.sql import text
 
-from flask import g, Flask, request, session, redirect, url_for, abort, render_template, flash, jsonify
+from flask import g, Flask, request, session, redirect, url_for, abort, render_template, flash, jsonify, make_response
 
 # setup sqlalchemy database tables
 metadata = MetaData()
@@ -34,6 +37,9 @@ posts = Table( 'posts', metadata,
     Column( 'post_date', Date )
 )
 
+# postgres error code for a query canceled by statement_timeout
+QUERY_CANCELED_PGCODE = '57014'
+
 # create our little application :)
 app = Flask(__name__)
 
@@ -46,7 +52,29 @@ app.config.update(dict(
     DATABASE_HOST='localhost',
     DEBUG=True,
     USERNAME='admin',
-    PASSWORD='default'
+    PASSWORD='default',
+    # seconds to wait for a new database connection before giving up
+    DATABASE_CONNECT_TIMEOUT=5,
+    # per endpoint class statement_timeout budgets in milliseconds
+    STATEMENT_TIMEOUTS={ 'read': 5000, 'search': 2000, 'write': 10000 },
+    # max number of requests per endpoint class allowed to hit the database at once.  limits and the
+    # circuit breaker are kept per worker process, so the site wide cap is this times the number of workers
+    CONCURRENCY_LIMITS={ 'read': 8, 'search': 2, 'write': 4 },
+    # consecutive database connection failures before the circuit breaker opens
+    CIRCUIT_BREAKER_THRESHOLD=5,
+    # consecutive statement timeouts per endpoint class before the circuit breaker opens; None means
+    # timeouts in that class never open it, so expensive searches only fail themselves
+    CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS={ 'read': 10, 'search': None, 'write': 10 },
+    # seconds the circuit breaker stays open before letting a request through to test the database
+    CIRCUIT_BREAKER_COOLDOWN=30,
+    # seconds sent to clients in the Retry-After header of a 503 response
+    RETRY_AFTER=5,
+    # default and max number of days of activity returned by /api/users/stats
+    STATS_DAYS=30,
+    STATS_MAX_DAYS=365,
+    # default and max number of users returned by /api/users/leaderboard
+    LEADERBOARD_LIMIT=10,
+    LEADERBOARD_MAX_LIMIT=100
 ))
 app.config.from_envvar( 'GOBBBBLER_SETTINGS', silent=True )
 
@@ -56,27 +84,49 @@ def connect_db():
     """Connects to the specific database."""
 
     # use nullpool because pooling breaks unit tests and we don't need the performance
-    return sqlalchemy.create_engine(
+    engine = sqlalchemy.create_engine(
         'postgresql://' +
         app.config[ 'DATABASE_USER' ] + ':' +
         app.config[ 'DATABASE_PASSWORD' ] + '@' +
         app.config[ 'DATABASE_HOST' ] + '/' +
         app.config[ 'DATABASE' ],
-        poolclass = sqlalchemy.pool.NullPool
+        poolclass = sqlalchemy.pool.NullPool,
+        connect_args = { 'connect_timeout': app.config[ 'DATABASE_CONNECT_TIMEOUT' ] }
     )
 
+    sqlalchemy.event.listen( engine, 'do_connect', set_statement_timeout )
+
+    return engine
+
+def set_statement_timeout( dialect, conn_rec, cargs, cparams ):
+    """pass the statement_timeout set by load_shedding() for the current request in the connection
+    startup options, so that it costs no extra round trip"""
+    if ( not g.get( 'statement_timeout' ) is None ):
+        cparams[ 'options' ] = '-c statement_timeout=' + str( g.statement_timeout )
+
 def init_db():
     """Initializes the database."""
     db = get_db()
     with app.open_resource( 'schema.sql', mode='r' ) as f:
         db.execute( f.read() )
 
+    create_user_stats( db )
+
+def create_user_stats( db ):
+    """Creates the user stats tables and the trigger that maintains them if they do not exist yet."""
+    with app.open_resource( 'user_stats.sql', mode='r' ) as f:
+        with db.begin():
+            db.execute( f.read() )
+
 def get_db():
     """Opens a new database connection if there is none yet for the current application context.
     return a connection for that database."""
     if ( g.get( 'db' ) is None ):
         g.db = connect_db()
 
+    # tells load_shedding() that the request reached the database
+    g.db_used = True
+
     return g.db.connect()
 
 def close_db():
@@ -86,6 +136,199 @@ def close_db():
 
     g.db = None
 
+def rebuild_user_stats():
+    """Rebuilds user_stats and user_daily_activity from the posts table."""
+    db = get_db()
+
+    # also migrates databases created before the stats tables existed.  run in its own transaction so
+    # that any locks it takes on posts are not held for the rest of the rebuild
+    create_user_stats( db )
+
+    with db.begin():
+        # block new posts until the rebuild commits so that the trigger cannot double count them
+        db.execute( 'lock table posts in share mode' )
+
+        db.execute( 'delete from user_daily_activity' )
+        db.execute( 'delete from user_stats' )
+
+        db.execute( 'insert into user_stats ( users_id, post_count, last_post_date ) select users_id, count(*), max( post_date ) from posts group by users_id' )
+        db.execute( 'insert into user_daily_activity ( users_id, day, post_count ) select users_id, post_date::date, count(*) from posts group by users_id, post_date::date' )
+
+# LOAD SHEDDING FUNCTIONS
+
+class CircuitBreaker:
+    """Track consecutive database connection failures and statement timeouts.  After threshold failures,
+    or the timeout threshold for an endpoint class of timeouts, in a row the breaker opens and
+    allow_request() returns False until cooldown seconds have passed, at which point a single request is
+    let through to test whether the database has recovered."""
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset( self ):
+        """close the breaker and forget all recorded failures"""
+        with self.lock:
+            self.failures = 0
+            self.timeouts = {}
+            self.opened_at = None
+
+    def allow_request( self ):
+        """return True if the request may use the database or False if it should fail fast"""
+        with self.lock:
+            if ( self.opened_at is None ):
+                return True
+
+            if ( time.time() - self.opened_at >= app.config[ 'CIRCUIT_BREAKER_COOLDOWN' ] ):
+                # half open: let this request through as a probe and keep failing fast for everyone
+                # else for another cooldown unless the probe records a success first
+                self.opened_at = time.time()
+                return True
+
+            return False
+
+    def trip( self ):
+        """open the breaker now"""
+        with self.lock:
+            self.failures = app.config[ 'CIRCUIT_BREAKER_THRESHOLD' ]
+            self.opened_at = time.time()
+
+    def record_failure( self ):
+        """record a database failure, opening the breaker if the threshold has been reached"""
+        with self.lock:
+            self.failures += 1
+            if ( self.failures >= app.config[ 'CIRCUIT_BREAKER_THRESHOLD' ] ):
+                self.opened_at = time.time()
+
+    def record_timeout( self, endpoint_class ):
+        """record a query canceled by statement_timeout, opening the breaker if the timeout threshold for
+        endpoint_class has been reached"""
+        threshold = app.config[ 'CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS' ][ endpoint_class ]
+
+        with self.lock:
+            self.timeouts[ endpoint_class ] = self.timeouts.get( endpoint_class, 0 ) + 1
+            if ( ( threshold is not None ) and ( self.timeouts[ endpoint_class ] >= threshold ) ):
+                self.opened_at = time.time()
+
+    def record_success( self, endpoint_class ):
+        """record a successful database request, closing the breaker"""
+        with self.lock:
+            self.failures = 0
+            self.timeouts[ endpoint_class ] = 0
+            self.opened_at = None
+
+circuit_breaker = CircuitBreaker()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# most recent timeline fetched by show_posts(), served while the database is unavailable
+_timeline_cache = None
+
+class ServiceUnavailable( Exception ):
+    """Raised by load_shedding() to reject a request with a 503.  if fallback is set, it is called to
+    generate the response instead, and the 503 is only sent if it returns None."""
+
+    def __init__( self, error, fallback = None ):
+        super().__init__( error )
+        self.error = error
+        self.fallback = fallback
+
+def get_limiter( endpoint_class ):
+    """return the semaphore capping concurrent database work for the given endpoint class"""
+    limit = app.config[ 'CONCURRENCY_LIMITS' ][ endpoint_class ]
+
+    # key on the limit as well so that config changes take effect
+    key = ( endpoint_class, limit )
+
+    with _limiters_lock:
+        if ( not key in _limiters ):
+            _limiters[ key ] = threading.BoundedSemaphore( limit )
+
+        return _limiters[ key ]
+
+def is_query_canceled( e ):
+    """return True if the sqlalchemy error e is a query canceled by statement_timeout"""
+    return getattr( e.orig, 'pgcode', None ) == QUERY_CANCELED_PGCODE
+
+def service_unavailable( error ):
+    """return a 503 response with a Retry-After header; json for api requests, plain text otherwise"""
+    if ( request.path.startswith( '/api/' ) ):
+        response = make_response( jsonify( { 'error': error } ), 503 )
+    else:
+        response = make_response( error, 503 )
+
+    response.headers[ 'Retry-After' ] = str( app.config[ 'RETRY_AFTER' ] )
+
+    return response
+
+@app.errorhandler( ServiceUnavailable )
+def handle_service_unavailable( e ):
+    if ( e.fallback is not None ):
+        response = e.fallback()
+        if ( response is not None ):
+            return response
+
+    return service_unavailable( e.error )
+
+@contextlib.contextmanager
+def load_shedding( endpoint_class, fallback = None ):
+    """context manager for database work.  applies the statement_timeout budget for endpoint_class and
+    raises ServiceUnavailable if too many requests of endpoint_class are already in flight, if the
+    circuit breaker is open, or if the database fails or times out.  connection failures count against
+    the circuit breaker; timeouts only count against it once CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS of them
+    in endpoint_class happen in a row."""
+
+    limiter = get_limiter( endpoint_class )
+    if ( not limiter.acquire( blocking = False ) ):
+        raise ServiceUnavailable( 'Too many requests; try again later', fallback )
+
+    try:
+        if ( not circuit_breaker.allow_request() ):
+            raise ServiceUnavailable( 'Database unavailable; try again later', fallback )
+
+        g.statement_timeout = app.config[ 'STATEMENT_TIMEOUTS' ][ endpoint_class ]
+        g.db_used = False
+
+        try:
+            yield
+        except sqlalchemy.exc.OperationalError as e:
+            if ( is_query_canceled( e ) ):
+                circuit_breaker.record_timeout( endpoint_class )
+                raise ServiceUnavailable( 'Request took too long; try again later', fallback ) from e
+
+            circuit_breaker.record_failure()
+            raise ServiceUnavailable( 'Database unavailable; try again later', fallback ) from e
+
+        # requests that never reached the database say nothing about its health
+        if ( g.db_used ):
+            circuit_breaker.record_success( endpoint_class )
+    finally:
+        g.statement_timeout = None
+        limiter.release()
+
+def shed_load( endpoint_class, fallback = None ):
+    """decorator that runs an entire end point inside load_shedding( endpoint_class, fallback )"""
+
+    def decorator( f ):
+        @functools.wraps( f )
+        def wrapper( *args, **kwargs ):
+            with load_shedding( endpoint_class, fallback ):
+                return f( *args, **kwargs )
+
+        return wrapper
+
+    return decorator
+
+def cached_timeline():
+    """render the cached timeline for a logged in user or return None if there is no cached timeline"""
+    if ( ( _timeline_cache is None ) or ( not 'users_id' in session ) ):
+        return None
+
+    flash( 'Gobbbbler is having trouble reaching its database; showing recent posts.' )
+
+    return render_template( 'show_posts.html', posts = _timeline_cache, user = { 'users_id': session[ 'users_id' ] } )
+
 # USER FUNCTIONS
 
 @app.cli.command('initdb')
@@ -93,6 +336,11 @@ def initdb_command():
     """Creates the database tables."""
     init_db()
 
+@app.cli.command('rebuildstats')
+def rebuildstats_command():
+    """Reconciles the user stats tables with the posts table."""
+    rebuild_user_stats()
+
 
 def authenticate_user( db, request ):
     """authenticate the username and password from the request, return the corresponding user dict if successful and
@@ -134,7 +382,10 @@ def require_user( request ):
 # WEB APP END POINTS
 
 @app.route ('/' )
+@shed_load( 'read', fallback = cached_timeline )
 def show_posts():
+    global _timeline_cache
+
     user = require_user( request )
     if ( not user ):
         return redirect( url_for( 'login' ) )
@@ -143,24 +394,27 @@ def show_posts():
 
     posts = db.execute( 'select u.users_id, u.name user_name, post, post_date from posts p join users u using ( users_id ) order by posts_id desc limit 100' ).fetchall()
 
+    _timeline_cache = [ dict( post.items() ) for post in posts ]
+
     return render_template('show_posts.html', posts=posts, user=user )
 
 
 @app.route( '/add', methods=[ 'POST' ] )
 def add_post():
 
-    user = require_user( request )
-    if ( not user ):
-        return redirect( url_for( 'login' ) )
+    with load_shedding( 'write' ):
+        user = require_user( request )
+        if ( not user ):
+            return redirect( url_for( 'login' ) )
 
-    post = request.form[ 'post' ]
+        post = request.form[ 'post' ]
 
-    if ( not post ):
-        return redirect( url_for( 'show_posts' ) )
+        if ( not post ):
+            return redirect( url_for( 'show_posts' ) )
 
-    db = get_db()
+        db = get_db()
 
-    db.execute( text( 'insert into posts ( users_id, post ) values ( :users_id, :post )' ), users_id = user[ 'users_id' ], post = post )
+        db.execute( text( 'insert into posts ( users_id, post ) values ( :users_id, :post )' ), users_id = user[ 'users_id' ], post = post )
 
     # sleep for two seconds to give any scripts time to respond before loading posts
     time.sleep( 2 )
@@ -174,9 +428,10 @@ def login():
     if ( request.method == 'GET' ):
         return render_template( 'login.html' )
 
-    db = get_db()
+    with load_shedding( 'read' ):
+        db = get_db()
 
-    user = authenticate_user( db, request )
+        user = authenticate_user( db, request )
 
     if ( user ):
         session[ 'users_id' ] = user[ 'users_id' ]
@@ -205,11 +460,12 @@ def register():
     if ( not ( username and email and password ) ):
         return render_template( 'register.html', error = 'username, email, and password are required' )
 
-    db = get_db()
+    with load_shedding( 'write' ):
+        db = get_db()
 
-    rowcount = db.execute( text( 'update users set is_active = true, name = :name, email = :email, password_hash = md5( :salt || :password ) where email = :email and password_hash is null' ),
-        name = username, email = email, password = password, salt = app.config[ 'SECRET_KEY' ]
-    ).rowcount
+        rowcount = db.execute( text( 'update users set is_active = true, name = :name, email = :email, password_hash = md5( :salt || :password ) where email = :email and password_hash is null' ),
+            name = username, email = email, password = password, salt = app.config[ 'SECRET_KEY' ]
+        ).rowcount
 
     if ( rowcount == 0 ):
         return render_template( 'register.html', error = 'email already registered or not recognized; please contact gobbbbler administrator' )
@@ -220,6 +476,7 @@ def register():
 
 
 @app.route( '/api/posts/list', methods = [ 'GET' ] )
+@shed_load( 'read' )
 def api_posts_list():
 
     db = get_db()
@@ -236,6 +493,7 @@ def api_posts_list():
     return jsonify( { 'posts': posts_dict } )
 
 @app.route( '/api/posts/search', methods = [ 'GET' ] )
+@shed_load( 'search' )
 def api_posts_search():
 
     db = get_db()
@@ -259,6 +517,7 @@ def api_posts_search():
     return jsonify( { 'posts': posts_dict } )
 
 @app.route( '/api/posts/user', methods = [ 'GET' ] )
+@shed_load( 'read' )
 def api_posts_user():
 
     db = get_db()
@@ -280,6 +539,7 @@ def api_posts_user():
     return jsonify( { 'posts': posts_dict } )
 
 @app.route( '/api/posts/send', methods = [ 'POST' ] )
+@shed_load( 'write' )
 def api_posts_send():
 
     db = get_db()
@@ -302,3 +562,62 @@ def api_posts_send():
     post = db.execute( text( 'insert into posts ( users_id, post ) values ( :users_id, :post ) returning *' ), users_id = user[ 'users_id' ], post = post ).fetchone()
 
     return jsonify( { 'posts': [ dict( post.items() )  ] } );
+
+def get_int_param( name, default, max_value ):
+    """return the named request parameter as an int between 1 and max_value, or default if it is missing
+    or not a number"""
+    try:
+        value = int( request.values.get( name, default ) )
+    except ValueError:
+        value = default
+
+    return max( 1, min( value, max_value ) )
+
+@app.route( '/api/users/stats', methods = [ 'GET' ] )
+@shed_load( 'read' )
+def api_users_stats():
+
+    db = get_db()
+
+    user = authenticate_user( db, request )
+
+    if ( not user ):
+        return jsonify( { 'error': 'Unable to login with given username and password' } )
+
+    name = request.values.get( 'user' )
+
+    if ( not name ):
+        name = user[ 'name' ]
+
+    days = get_int_param( 'days', app.config[ 'STATS_DAYS' ], app.config[ 'STATS_MAX_DAYS' ] )
+
+    stats = db.execute( text( 'select u.users_id, u.name user_name, coalesce( s.post_count, 0 ) post_count, s.last_post_date from users u left join user_stats s using ( users_id ) where u.name = :user and u.is_active' ), user = name ).fetchone()
+
+    if ( not stats ):
+        return jsonify( { 'error': 'No such user: ' + name } )
+
+    activity = db.execute( text( 'select day, post_count from user_daily_activity where users_id = :users_id and day > current_date - :days order by day desc' ), users_id = stats[ 'users_id' ], days = days ).fetchall()
+
+    stats_dict = dict( stats.items() )
+    stats_dict[ 'activity' ] = [ { 'day': day[ 'day' ].isoformat(), 'post_count': day[ 'post_count' ] } for day in activity ]
+
+    return jsonify( { 'stats': stats_dict } )
+
+@app.route( '/api/users/leaderboard', methods = [ 'GET' ] )
+@shed_load( 'read' )
+def api_users_leaderboard():
+
+    db = get_db()
+
+    user = authenticate_user( db, request )
+
+    if ( not user ):
+        return jsonify( { 'error': 'Unable to login with given username and password' } )
+
+    limit = get_int_param( 'limit', app.config[ 'LEADERBOARD_LIMIT' ], app.config[ 'LEADERBOARD_MAX_LIMIT' ] )
+
+    leaders = db.execute( text( 'select u.users_id, u.name user_name, s.post_count, s.last_post_date from user_stats s join users u using ( users_id ) where u.is_active order by s.post_count desc, s.users_id limit :limit' ), limit = limit ).fetchall()
+
+    leaders_dict = [ ( dict( leader.items() ) ) for leader in leaders ]
+
+    return jsonify( { 'users': leaders_dict } )
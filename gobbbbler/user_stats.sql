@@ -0,0 +1,40 @@
+-- per user statistics, maintained by the posts_user_stats trigger and reconciled by flask rebuildstats.
+-- safe to run against an existing database; flask rebuildstats runs it before rebuilding.
+create table if not exists user_stats (
+    users_id        int primary key references users,
+    post_count      int not null default 0,
+    last_post_date  timestamp with time zone
+);
+
+create index if not exists user_stats_post_count on user_stats ( post_count desc, users_id );
+
+create table if not exists user_daily_activity (
+    users_id    int not null references users,
+    day         date not null,
+    post_count  int not null default 0,
+    primary key ( users_id, day )
+);
+
+-- upsert so that concurrent inserts for the same user serialize on the stats row instead of racing
+create or replace function update_user_stats() returns trigger as $$
+begin
+    insert into user_stats ( users_id, post_count, last_post_date ) values ( new.users_id, 1, new.post_date )
+        on conflict ( users_id ) do update set
+            post_count = user_stats.post_count + 1,
+            last_post_date = greatest( user_stats.last_post_date, excluded.last_post_date );
+
+    insert into user_daily_activity ( users_id, day, post_count ) values ( new.users_id, new.post_date::date, 1 )
+        on conflict ( users_id, day ) do update set post_count = user_daily_activity.post_count + 1;
+
+    return null;
+end;
+$$ language plpgsql;
+
+-- only create the trigger when it is missing; dropping it would lock out readers of posts
+do $$
+begin
+    if not exists ( select 1 from pg_trigger where tgname = 'posts_user_stats' and tgrelid = 'posts'::regclass ) then
+        create trigger posts_user_stats after insert on posts for each row execute procedure update_user_stats();
+    end if;
+end;
+$$;
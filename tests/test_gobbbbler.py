@@ -13,13 +13,14 @@ import json
 import multiprocessing
 import os
 import pytest
+import requests
 import signal
 import time
 import unittest
 import urllib
 
 from context import gobbbbler
-from gobbbbler.client import Turkey
+from gobbbbler.client import Turkey, GobbbblerError, GobbbblerUnavailableError
 
 from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Date
 from sqlalchemy.sql import text
@@ -57,6 +58,11 @@ class GobbbblerTestCase( unittest.TestCase ):
         """
         self.client = gobbbbler.app.test_client()
 
+        # load shedding state is kept per process, so don't let one test leak it into the next
+        gobbbbler.circuit_breaker.reset()
+        gobbbbler._timeline_cache = None
+        gobbbbler._limiters.clear()
+
         with gobbbbler.app.app_context():
             self.original_db_name = gobbbbler.app.config['DATABASE']
             self.test_db_name = "gobbbbler_test"
@@ -216,6 +222,306 @@ class GobbbblerTestCase( unittest.TestCase ):
         assert first_post[ 'users_id' ] == 1
         assert first_post[ 'user_name' ] == 'foo'
 
+    def test_api_users_stats( self ):
+        """ test /api/users/stats """
+        params = self.get_test_user_form();
+        params[ 'user' ] = 'bar'
+
+        rv = self.client.get( '/api/users/stats?' + urllib.parse.urlencode( params ) )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert 'stats' in json_data
+
+        stats = json_data[ 'stats' ]
+
+        assert stats[ 'users_id' ] == 2
+        assert stats[ 'user_name' ] == 'bar'
+        assert stats[ 'post_count' ] == 2
+        assert stats[ 'last_post_date' ] is not None
+        assert sum( day[ 'post_count' ] for day in stats[ 'activity' ] ) == 2
+
+        # stats should be updated by a new post and default to the authenticated user
+        url = '/api/posts/send?' + urllib.parse.urlencode( self.get_test_user_form() )
+        self.client.post( url, data = json.dumps( { 'post': 'json post' } ), content_type = 'application/json' )
+
+        rv = self.client.get( '/api/users/stats?' + urllib.parse.urlencode( self.get_test_user_form() ) )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert json_data[ 'stats' ][ 'user_name' ] == 'foo'
+        assert json_data[ 'stats' ][ 'post_count' ] == 3
+        assert sum( day[ 'post_count' ] for day in json_data[ 'stats' ][ 'activity' ] ) == 3
+
+        # deactivated users are not reported
+        with gobbbbler.app.app_context():
+            gobbbbler.get_db().execute( "update users set is_active = false where name = 'bar'" )
+
+        rv = self.client.get( '/api/users/stats?' + urllib.parse.urlencode( params ) )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert 'error' in json_data
+
+    def test_api_users_leaderboard( self ):
+        """ test /api/users/leaderboard """
+        url = '/api/posts/send?' + urllib.parse.urlencode( self.get_test_user_form() )
+        self.client.post( url, data = json.dumps( { 'post': 'json post' } ), content_type = 'application/json' )
+
+        params = self.get_test_user_form();
+        params[ 'limit' ] = 1
+
+        rv = self.client.get( '/api/users/leaderboard?' + urllib.parse.urlencode( params ) )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert 'users' in json_data
+
+        assert len( json_data[ 'users' ] ) == 1
+
+        leader = json_data[ 'users' ][ 0 ]
+
+        assert leader[ 'user_name' ] == 'foo'
+        assert leader[ 'post_count' ] == 3
+
+        # deactivated users are left off the leaderboard
+        with gobbbbler.app.app_context():
+            gobbbbler.get_db().execute( "update users set is_active = false where name = 'bar'" )
+
+        rv = self.client.get( '/api/users/leaderboard?' + urllib.parse.urlencode( self.get_test_user_form() ) )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert [ leader[ 'user_name' ] for leader in json_data[ 'users' ] ] == [ 'foo' ]
+
+    def test_rebuild_user_stats( self ):
+        """ test that rebuild_user_stats() reconciles user stats with posts """
+        with gobbbbler.app.app_context():
+            db = gobbbbler.get_db()
+            db.execute( 'update user_stats set post_count = 100' )
+            db.execute( 'delete from user_daily_activity' )
+
+            gobbbbler.rebuild_user_stats()
+
+            stats = db.execute( 'select users_id, post_count from user_stats order by users_id' ).fetchall()
+            assert [ ( s[ 'users_id' ], s[ 'post_count' ] ) for s in stats ] == [ ( 1, 2 ), ( 2, 2 ) ]
+
+            activity = db.execute( 'select sum( post_count ) from user_daily_activity' ).scalar()
+            assert activity == 4
+
+    def test_rebuild_user_stats_migrates( self ):
+        """ test that rebuild_user_stats() creates the stats tables and trigger in an older database """
+        with gobbbbler.app.app_context():
+            db = gobbbbler.get_db()
+            db.execute( 'drop table user_daily_activity, user_stats' )
+            db.execute( 'drop function update_user_stats() cascade' )
+
+            gobbbbler.rebuild_user_stats()
+
+            stats = db.execute( 'select users_id, post_count from user_stats order by users_id' ).fetchall()
+            assert [ ( s[ 'users_id' ], s[ 'post_count' ] ) for s in stats ] == [ ( 1, 2 ), ( 2, 2 ) ]
+
+            db.execute( text( 'insert into posts ( users_id, post ) values ( 1, :post )' ), post = 'migrated post' )
+
+            post_count = db.execute( 'select post_count from user_stats where users_id = 1' ).scalar()
+            assert post_count == 3
+
+    def test_api_circuit_breaker( self ):
+        """ test that api requests fail fast with a 503 while the circuit breaker is open """
+        gobbbbler.circuit_breaker.trip()
+
+        try:
+            rv = self.client.get( '/api/posts/list?' + urllib.parse.urlencode( self.get_test_user_form() ) )
+        finally:
+            gobbbbler.circuit_breaker.reset()
+
+        assert rv.status_code == 503
+        assert rv.headers[ 'Retry-After' ] == str( gobbbbler.app.config[ 'RETRY_AFTER' ] )
+
+        json_data = json.loads( rv.data.decode( 'utf-8' ) )
+
+        assert 'error' in json_data
+
+        rv = self.client.get( '/api/posts/list?' + urllib.parse.urlencode( self.get_test_user_form() ) )
+        assert rv.status_code == 200
+
+    def test_cached_timeline( self ):
+        """ test that / serves the cached timeline while the circuit breaker is open """
+        rv = self.login( TEST_USERS[ 0 ][ 'name' ], TEST_USERS[ 0 ][ 'password' ] )
+        assert b'first post' in rv.data
+
+        gobbbbler.circuit_breaker.trip()
+
+        try:
+            rv = self.client.get( '/' )
+        finally:
+            gobbbbler.circuit_breaker.reset()
+
+        assert rv.status_code == 200
+        assert b'first post' in rv.data
+        assert b'having trouble' in rv.data
+
+        # the cached timeline is also served when every read slot is taken
+        with gobbbbler.app.app_context():
+            limiter = gobbbbler.get_limiter( 'read' )
+
+        held = 0
+        while ( limiter.acquire( blocking = False ) ):
+            held += 1
+
+        try:
+            rv = self.client.get( '/' )
+        finally:
+            for i in range( held ):
+                limiter.release()
+
+        assert rv.status_code == 200
+        assert b'having trouble' in rv.data
+
+    def test_api_concurrency_limit( self ):
+        """ test that requests over the concurrency limit for an endpoint class are rejected with a 503 """
+        params = self.get_test_user_form();
+        params[ 'q' ] = 'second'
+
+        with gobbbbler.app.app_context():
+            limiter = gobbbbler.get_limiter( 'search' )
+
+        # hold every search slot as if that many searches were in flight
+        held = 0
+        while ( limiter.acquire( blocking = False ) ):
+            held += 1
+
+        try:
+            rv = self.client.get( '/api/posts/search?' + urllib.parse.urlencode( params ) )
+        finally:
+            for i in range( held ):
+                limiter.release()
+
+        assert held == gobbbbler.app.config[ 'CONCURRENCY_LIMITS' ][ 'search' ]
+        assert rv.status_code == 503
+        assert 'Retry-After' in rv.headers
+
+        rv = self.client.get( '/api/posts/search?' + urllib.parse.urlencode( params ) )
+        assert rv.status_code == 200
+
+    def test_statement_timeout( self ):
+        """ test that load_shedding() applies the statement_timeout for the endpoint class and that a
+            canceled query fails the request without counting against the circuit breaker
+        """
+        timeouts = gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ]
+        gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ] = dict( timeouts, search = 100 )
+
+        try:
+            with gobbbbler.app.test_request_context( '/api/posts/search' ):
+                with gobbbbler.load_shedding( 'search' ):
+                    assert gobbbbler.get_db().execute( 'show statement_timeout' ).scalar() == '100ms'
+
+                with pytest.raises( gobbbbler.ServiceUnavailable ):
+                    with gobbbbler.load_shedding( 'search' ):
+                        gobbbbler.get_db().execute( 'select pg_sleep( 1 )' )
+
+                gobbbbler.close_db()
+        finally:
+            gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ] = timeouts
+
+        assert gobbbbler.circuit_breaker.failures == 0
+        assert gobbbbler.circuit_breaker.allow_request()
+
+    def test_statement_timeouts_open_breaker( self ):
+        """ test that repeated read timeouts open the circuit breaker and search timeouts do not """
+        timeouts = gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ]
+        thresholds = gobbbbler.app.config[ 'CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS' ]
+        gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ] = dict( timeouts, read = 100, search = 100 )
+        gobbbbler.app.config[ 'CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS' ] = dict( thresholds, read = 2, search = None )
+
+        try:
+            with gobbbbler.app.test_request_context( '/' ):
+                for endpoint_class in [ 'search', 'search', 'read', 'read' ]:
+                    assert gobbbbler.circuit_breaker.allow_request()
+
+                    with pytest.raises( gobbbbler.ServiceUnavailable ):
+                        with gobbbbler.load_shedding( endpoint_class ):
+                            gobbbbler.get_db().execute( 'select pg_sleep( 1 )' )
+
+                gobbbbler.close_db()
+
+                assert not gobbbbler.circuit_breaker.allow_request()
+        finally:
+            gobbbbler.app.config[ 'STATEMENT_TIMEOUTS' ] = timeouts
+            gobbbbler.app.config[ 'CIRCUIT_BREAKER_TIMEOUT_THRESHOLDS' ] = thresholds
+            gobbbbler.circuit_breaker.reset()
+
+    def test_circuit_breaker_opens( self ):
+        """ test that database connection failures open the circuit breaker """
+        threshold = gobbbbler.app.config[ 'CIRCUIT_BREAKER_THRESHOLD' ]
+        url = '/api/posts/list?' + urllib.parse.urlencode( self.get_test_user_form() )
+
+        gobbbbler.app.config[ 'DATABASE' ] = 'gobbbbler_test_missing'
+
+        try:
+            for i in range( threshold ):
+                rv = self.client.get( url )
+                assert rv.status_code == 503
+
+            gobbbbler.app.config[ 'DATABASE' ] = self.test_db_name
+
+            # the database is back, but the breaker should fail fast until the cooldown passes
+            rv = self.client.get( url )
+            assert rv.status_code == 503
+            assert gobbbbler.circuit_breaker.failures == threshold
+        finally:
+            gobbbbler.app.config[ 'DATABASE' ] = self.test_db_name
+            gobbbbler.circuit_breaker.reset()
+
+        rv = self.client.get( url )
+        assert rv.status_code == 200
+
+    def test_circuit_breaker_probe( self ):
+        """ test that a single probe request is let through once the circuit breaker cooldown passes """
+        cooldown = gobbbbler.app.config[ 'CIRCUIT_BREAKER_COOLDOWN' ]
+
+        try:
+            with gobbbbler.app.app_context():
+                gobbbbler.circuit_breaker.trip()
+                assert not gobbbbler.circuit_breaker.allow_request()
+
+                gobbbbler.app.config[ 'CIRCUIT_BREAKER_COOLDOWN' ] = 0.5
+                time.sleep( 0.5 )
+
+                assert gobbbbler.circuit_breaker.allow_request()
+                assert not gobbbbler.circuit_breaker.allow_request()
+
+                gobbbbler.circuit_breaker.record_success( 'read' )
+                assert gobbbbler.circuit_breaker.allow_request()
+        finally:
+            gobbbbler.app.config[ 'CIRCUIT_BREAKER_COOLDOWN' ] = cooldown
+            gobbbbler.circuit_breaker.reset()
+
+    def test_forms_while_circuit_breaker_open( self ):
+        """ test that the login and register forms load while the circuit breaker is open """
+        gobbbbler.circuit_breaker.trip()
+
+        try:
+            assert self.client.get( '/login' ).status_code == 200
+            assert self.client.get( '/register' ).status_code == 200
+            assert self.login( TEST_USERS[ 0 ][ 'name' ], TEST_USERS[ 0 ][ 'password' ] ).status_code == 503
+        finally:
+            gobbbbler.circuit_breaker.reset()
+
+    def test_client_unavailable( self ):
+        """ test that Turkey raises GobbbblerUnavailableError for a 503 response """
+        r = requests.models.Response()
+        r.status_code = 503
+        r.headers[ 'Retry-After' ] = '5'
+        r._content = b'{"error": "Too many requests; try again later"}'
+
+        turkey = Turkey( username = TEST_USERS[0][ 'name' ], password = TEST_USERS[0][ 'password' ] )
+
+        with pytest.raises( GobbbblerUnavailableError ) as e:
+            turkey._check_response( r )
+
+        assert e.value.retry_after == 5
+
     def test_client_api( self ):
         """ test gobbbbler/client.py by starting flask in a separate thread """
 
@@ -257,6 +563,12 @@ class GobbbblerTestCase( unittest.TestCase ):
 
         assert post == 'user post'
 
+        # test that errors from the service are raised
+        bad_turkey = Turkey( username = TEST_USERS[0][ 'name' ], password = 'invalid password', url = 'http://localhost:5000' )
+
+        with pytest.raises( GobbbblerError ):
+            bad_turkey.send( 'bad post' )
+
         os.kill ( flask_pid, signal.SIGKILL )
 
 